@@ -7,18 +7,198 @@ This FastAPI application exposes endpoints for:
 * Issuing enrollment tokens tied to a site
 * Registering an edge controller via a token
 * Fetching an edge's desired configuration after registration
+* Pushing configuration changes to connected edges over a WebSocket
 
-All data is stored in process memory.  In a production implementation you
-would back these dictionaries with a database.
+All state is kept in Redis so the API can run with several workers; only
+the open WebSocket connections live in process memory.  Configuration
+changes are fanned out to every worker through Redis pub/sub.
 """
 
-from fastapi import FastAPI, HTTPException
+from contextlib import asynccontextmanager
+from fastapi import (
+    Body,
+    FastAPI,
+    HTTPException,
+    Request,
+    WebSocket,
+    WebSocketDisconnect,
+)
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, Response
 from pydantic import BaseModel
-from typing import Dict, Optional, List
-import uuid
+from redis.asyncio import Redis
+from redis.exceptions import WatchError
+from typing import AsyncIterator, Dict, List, Optional
+import asyncio
+import hashlib
+import json
+import logging
+import orjson
+import os
+import secrets
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://redis:6379/0")
+# Unused enrollment tokens expire after this many seconds
+ENROLLMENT_TOKEN_TTL = 600
+
+# Redis layout.  Site IDs may contain ":", so every key type gets its own
+# prefix rather than a suffix that could collide with another site's key.
+#   site:{site_id}        hash  {"body": config JSON, "etag": ETag}
+#   site_edges:{site_id}  set   edge_ids registered to the site
+#   tok:{token}           str   site_id, single use with a TTL
+#   edges                 hash  edge_id -> {"site_id", "edge_id"} JSON
+#   config:{site_id}      pub/sub channel carrying config push messages
+store = Redis.from_url(REDIS_URL, decode_responses=True)
+
+logger = logging.getLogger(__name__)
+
+# Open config streams on this worker, keyed by edge_id
+edge_sockets: Dict[str, WebSocket] = {}
+
+
+class RegisterRequest(BaseModel):
+    edge_id: str
+    token: str
+
+
+def dump_json(obj: Dict) -> bytes:
+    """Serialize `obj` to compact JSON bytes.
+
+    orjson is used where possible; the stdlib handles valid JSON that
+    orjson refuses, such as integers wider than 64 bits.
+    """
+    try:
+        return orjson.dumps(obj)
+    except orjson.JSONEncodeError:
+        return json.dumps(obj, separators=(",", ":")).encode()
+
+
+def compute_etag(raw: bytes) -> str:
+    """Return a strong ETag for a serialized config."""
+    digest = hashlib.blake2b(raw, digest_size=16).hexdigest()
+    return f'"{digest}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Return True if an If-None-Match header matches `etag`.
+
+    Handles ``*`` and comma-separated lists, and compares weakly (a
+    ``W/`` prefix is ignored) as RFC 9110 requires for If-None-Match.
+    """
+    if not if_none_match:
+        return False
+
+    def opaque(tag: str) -> str:
+        return tag[2:] if tag.startswith("W/") else tag
+
+    etag = opaque(etag)
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or opaque(candidate) == etag:
+            return True
+    return False
+
+
+def config_response(request: Request, site: Dict[str, str]) -> Response:
+    """Return a site's config, or 304 if the client already has it.
+
+    The config is serialized once when it is saved, so the stored JSON is
+    sent as-is rather than being decoded and re-encoded per request.
+    """
+    etag = site["etag"]
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(
+        content=site["body"],
+        media_type="application/json",
+        headers={"ETag": etag},
+    )
+
 
-app = FastAPI(title="Microgrid Cloud API", version="0.4.0")
+async def push_config(site_id: str, message: str) -> None:
+    """Send a config message to the site's edges connected to this worker."""
+    for edge_id in await store.smembers(f"site_edges:{site_id}"):
+        ws = edge_sockets.get(edge_id)
+        if ws is None:
+            continue
+        try:
+            await ws.send_text(message)
+        except Exception:
+            # The edge went away; it will reconcile when it reconnects.
+            if edge_sockets.get(edge_id) is ws:
+                del edge_sockets[edge_id]
+
+
+async def close_local_sockets() -> None:
+    """Close every config stream on this worker.
+
+    Edges fetch their config with a GET when the stream drops and then
+    reconnect, so this brings them back in sync after missed pushes.
+    """
+    for ws in list(edge_sockets.values()):
+        try:
+            # 1012: service restart
+            await ws.close(code=1012)
+        except Exception:
+            pass
+
+
+async def relay_config_updates() -> None:
+    """Forward config changes published by any worker to local sockets.
+
+    Runs until cancelled: a failing message is logged and skipped, and a
+    lost subscription is re-established.
+    """
+    resubscribing = False
+    while True:
+        pubsub = store.pubsub()
+        try:
+            await pubsub.psubscribe("config:*")
+            if resubscribing:
+                # Pushes published while we were unsubscribed are lost; make
+                # this worker's edges reconnect and fetch the current config.
+                await close_local_sockets()
+            async for msg in pubsub.listen():
+                if msg["type"] != "pmessage":
+                    continue
+                site_id = msg["channel"][len("config:"):]
+                try:
+                    await push_config(site_id, msg["data"])
+                except Exception:
+                    logger.exception("Failed to push config for site %s", site_id)
+        except Exception:
+            logger.exception("Config relay subscription failed; resubscribing")
+            await asyncio.sleep(1.0)
+        finally:
+            resubscribing = True
+            try:
+                await pubsub.aclose()
+            except Exception:
+                pass
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    """Run the pub/sub relay for the lifetime of the worker."""
+    task = asyncio.create_task(relay_config_updates())
+    try:
+        yield
+    finally:
+        task.cancel()
+        # Let the relay finish unwinding before the pool goes away
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        await store.aclose()
+
+
+app = FastAPI(
+    title="Microgrid Cloud API",
+    version="0.4.0",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan,
+)
 
 # Allow all origins during development so the browser UI can connect
 app.add_middleware(
@@ -29,24 +209,6 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# In-memory data stores.  In a real deployment these would be persistent.
-sites: Dict[str, Dict] = {}
-enrollment_tokens: Dict[str, str] = {}
-edges: Dict[str, Dict] = {}
-
-
-class DesiredConfig(BaseModel):
-    """The desired configuration posted by the user.
-
-    We accept any JSON payload here.  Pydantic will treat it as a dict.
-    """
-    __root__: Dict
-
-
-class RegisterRequest(BaseModel):
-    edge_id: str
-    token: str
-
 
 @app.get("/health")
 def health() -> Dict[str, str]:
@@ -55,41 +217,60 @@ def health() -> Dict[str, str]:
 
 
 @app.post("/api/sites/{site_id}/desired-config")
-def set_desired_config(site_id: str, config: DesiredConfig) -> Dict[str, str]:
+async def set_desired_config(
+    site_id: str, config: Dict = Body(...)
+) -> Dict[str, str]:
     """Persist the desired configuration for a site.
 
-    This will overwrite any existing configuration for the site.
+    We accept any JSON object here and store it as-is.  This will
+    overwrite any existing configuration for the site and push the new
+    configuration to any of the site's edges that are connected.
     """
-    sites[site_id] = config.__root__
+    raw = dump_json(config)
+    etag = compute_etag(raw)
+    body = raw.decode()
+    message = dump_json(
+        {"site_id": site_id, "config": config, "etag": etag}
+    ).decode()
+    async with store.pipeline(transaction=True) as pipe:
+        pipe.hset(f"site:{site_id}", mapping={"body": body, "etag": etag})
+        pipe.publish(f"config:{site_id}", message)
+        await pipe.execute()
     return {"status": "saved"}
 
 
 @app.get("/api/sites/{site_id}/desired-config")
-def get_desired_config(site_id: str) -> Dict:
+async def get_desired_config(site_id: str, request: Request) -> Response:
     """Return the desired configuration for a site."""
-    if site_id not in sites:
+    site = await store.hgetall(f"site:{site_id}")
+    if not site:
         raise HTTPException(status_code=404, detail="site not found")
-    return sites[site_id]
+    return config_response(request, site)
 
 
 @app.post("/api/sites/{site_id}/enrollment-token")
-def generate_token(site_id: str) -> Dict[str, str]:
+async def generate_token(site_id: str) -> Dict[str, str]:
     """Generate an enrollment token for a site.
 
     Tokens are single use.  When an edge registers with this token
-    it will be removed from the token store.
+    it will be removed from the token store.  Unused tokens expire after
+    `ENROLLMENT_TOKEN_TTL` seconds.
     """
     # Ensure the site exists before generating a token
-    if site_id not in sites:
+    if not await store.exists(f"site:{site_id}"):
         raise HTTPException(status_code=404, detail="site not found")
-    # Generate a random token and map it to the site
-    token = uuid.uuid4().hex
-    enrollment_tokens[token] = site_id
-    return {"token": token}
+    # Generate a random token and map it to the site.  NX makes sure a
+    # (vanishingly unlikely) collision never overwrites a live token.
+    while True:
+        token = secrets.token_hex(16)
+        if await store.set(
+            f"tok:{token}", site_id, ex=ENROLLMENT_TOKEN_TTL, nx=True
+        ):
+            return {"token": token}
 
 
 @app.post("/api/edge/register")
-def register_edge(req: RegisterRequest) -> Dict[str, str]:
+async def register_edge(req: RegisterRequest) -> Dict[str, str]:
     """Register an edge controller using an enrollment token.
 
     The request must include an `edge_id` (a unique identifier for the
@@ -97,32 +278,80 @@ def register_edge(req: RegisterRequest) -> Dict[str, str]:
     particular site.  On success this endpoint returns the site_id so
     that the edge knows which desired configuration to pull.
     """
-    # Validate token
+    # Validate token; GETDEL consumes it atomically across workers
     token = req.token
     edge_id = req.edge_id
-    if token not in enrollment_tokens:
+    site_id = await store.getdel(f"tok:{token}")
+    if site_id is None:
         raise HTTPException(status_code=400, detail="invalid or expired token")
-    site_id = enrollment_tokens.pop(token)
-    # Register the edge to the site
-    edges[edge_id] = {"site_id": site_id, "edge_id": edge_id}
+    # Register the edge to the site.  If it is moving from another site,
+    # drop it from that site's index so it stops receiving its pushes.
+    # WATCH makes the read of the previous site part of the transaction;
+    # a concurrent registration aborts it and we retry.
+    edge = orjson.dumps({"site_id": site_id, "edge_id": edge_id}).decode()
+    async with store.pipeline(transaction=True) as pipe:
+        while True:
+            try:
+                await pipe.watch("edges")
+                previous = await pipe.hget("edges", edge_id)
+                pipe.multi()
+                if previous is not None:
+                    old_site_id = orjson.loads(previous)["site_id"]
+                    if old_site_id != site_id:
+                        pipe.srem(f"site_edges:{old_site_id}", edge_id)
+                pipe.hset("edges", edge_id, edge)
+                pipe.sadd(f"site_edges:{site_id}", edge_id)
+                await pipe.execute()
+                break
+            except WatchError:
+                continue
     return {"site_id": site_id}
 
 
 @app.get("/api/edges/{edge_id}/desired-config")
-def get_edge_config(edge_id: str) -> Dict:
+async def get_edge_config(edge_id: str, request: Request) -> Response:
     """Return the desired configuration for an edge.
 
-    The edge must be registered; otherwise this returns 404.
+    The edge must be registered; otherwise this returns 404.  Send the
+    last ``ETag`` in ``If-None-Match`` to get a 304 when nothing changed.
     """
-    if edge_id not in edges:
+    edge = await store.hget("edges", edge_id)
+    if edge is None:
         raise HTTPException(status_code=404, detail="edge not registered")
-    site_id = edges[edge_id]["site_id"]
-    if site_id not in sites:
+    site_id = orjson.loads(edge)["site_id"]
+    site = await store.hgetall(f"site:{site_id}")
+    if not site:
         raise HTTPException(status_code=404, detail="site not found")
-    return sites[site_id]
+    return config_response(request, site)
+
+
+@app.websocket("/api/edges/{edge_id}/stream")
+async def edge_stream(websocket: WebSocket, edge_id: str) -> None:
+    """Stream desired configuration changes to a registered edge.
+
+    Each time the edge's site configuration is saved a JSON message of the
+    form ``{"site_id": ..., "config": {...}, "etag": ...}`` is sent.  The
+    edge should fetch the config once after connecting to catch up on
+    missed changes.
+    """
+    if not await store.hexists("edges", edge_id):
+        # Closing before accept rejects the handshake
+        await websocket.close(code=1008)
+        return
+    await websocket.accept()
+    edge_sockets[edge_id] = websocket
+    try:
+        # Nothing is expected from the edge; this just waits for disconnect
+        while True:
+            await websocket.receive_text()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        if edge_sockets.get(edge_id) is websocket:
+            del edge_sockets[edge_id]
 
 
 @app.get("/api/edges")
-def list_edges() -> Dict[str, List[Dict[str, str]]]:
+async def list_edges() -> Dict[str, List[Dict[str, str]]]:
     """List all registered edges and the sites they belong to."""
-    return {"edges": list(edges.values())}
+    return {"edges": [orjson.loads(e) for e in await store.hvals("edges")]}
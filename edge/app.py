@@ -16,24 +16,56 @@ skeleton of how you would plug in registration and configuration logic.
 """
 
 import os
+import json
 import asyncio
+import logging
 import httpx
 import random
+import time
+import websockets
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from typing import Dict, Any, Optional
+from typing import AsyncIterator, Dict, Any, Optional, Tuple
+
+logger = logging.getLogger(__name__)
 
 
 class EdgeState:
     """Holds the current registration and configuration state for the edge."""
-    def __init__(self, edge_id: str, cloud_url: str, token: Optional[str]):
+    def __init__(
+        self,
+        edge_id: str,
+        cloud_url: str,
+        token: Optional[str],
+        poll_interval: float = 15.0,
+    ):
         self.edge_id = edge_id
         self.cloud_url = cloud_url.rstrip("/")
+        # http://... -> ws://..., https://... -> wss://...
+        self.stream_url = (
+            "ws" + self.cloud_url[len("http"):] + f"/api/edges/{edge_id}/stream"
+        )
+        self._config_path = f"/api/edges/{edge_id}/desired-config"
         self.token = token
+        self.poll_interval = poll_interval
         self.site_id: Optional[str] = None
         self.registered: bool = False
         self.config: Optional[Dict[str, Any]] = None
+        # ETag of `config`, sent back so unchanged configs return 304
+        self.config_etag: Optional[str] = None
+        # Shared HTTP client, created by the app lifespan so keep-alive
+        # connections to the cloud are reused between polls.  Its base_url
+        # is `cloud_url`, so requests use paths relative to it.
+        self.client: Optional[httpx.AsyncClient] = None
+        # Caps in-flight cloud requests so a slow cloud applies backpressure
+        # instead of piling up connections and file descriptors
+        self._sem = asyncio.Semaphore(4)
+        # Delay before reopening the config stream after a disconnect
+        self._backoff: float = 1.0
+        # Set once registration succeeds; gates the config stream
+        self._registered_evt = asyncio.Event()
 
     async def register_with_cloud(self) -> None:
         """Attempt to register with the cloud using the token.
@@ -43,59 +75,147 @@ class EdgeState:
         if not self.token:
             # No token provided; cannot register automatically.
             return
-        url = f"{self.cloud_url}/api/edge/register"
         payload = {"edge_id": self.edge_id, "token": self.token}
-        async with httpx.AsyncClient() as client:
-            try:
-                resp = await client.post(url, json=payload, timeout=10.0)
-                resp.raise_for_status()
-            except httpx.HTTPError:
-                # Failed to register; do nothing.  We'll retry later.
-                return
-            data = resp.json()
-            self.site_id = data.get("site_id")
-            # Registration complete – clear the token so we don't retry
-            self.token = None
-            self.registered = True
+        try:
+            async with self._sem:
+                resp = await self.client.post("/api/edge/register", json=payload)
+            resp.raise_for_status()
+        except httpx.HTTPError:
+            # Failed to register; do nothing.  We'll retry later.
+            return
+        data = resp.json()
+        self.site_id = data.get("site_id")
+        # Registration complete – clear the token so we don't retry
+        self.token = None
+        self.registered = True
+        self._registered_evt.set()
 
     async def refresh_config(self) -> None:
         """Fetch the desired configuration from the cloud, if registered."""
         if not self.registered or not self.site_id:
             return
-        url = f"{self.cloud_url}/api/edges/{self.edge_id}/desired-config"
-        async with httpx.AsyncClient() as client:
-            try:
-                resp = await client.get(url, timeout=10.0)
-                resp.raise_for_status()
-            except httpx.HTTPError:
+        headers = {"If-None-Match": self.config_etag} if self.config_etag else {}
+        try:
+            async with self._sem:
+                resp = await self.client.get(self._config_path, headers=headers)
+            if resp.status_code == 304:
+                # Not modified; the config we have is current
                 return
-            self.config = resp.json()
+            resp.raise_for_status()
+            config = resp.json()
+        except (httpx.HTTPError, ValueError):
+            # Failed request or a non-JSON body (e.g. a proxy error page)
+            return
+        self.config = config
+        self.config_etag = resp.headers.get("ETag")
 
-    async def run_background_tasks(self) -> None:
-        """Main background loop for registration and configuration refresh."""
-        # Try to register on startup if we have a token
-        if self.token:
+    async def stream_config(self) -> None:
+        """Hold a WebSocket open to the cloud and apply pushed configs.
+
+        Returns when the connection closes; raises if it cannot be opened.
+        """
+        async with websockets.connect(self.stream_url) as ws:
+            self._backoff = 1.0
+            # Catch up on anything that changed while we were disconnected
+            await self.refresh_config()
+            async for message in ws:
+                try:
+                    data = json.loads(message)
+                    config = data["config"]
+                except (ValueError, TypeError, KeyError):
+                    logger.warning("Ignoring malformed config push: %r", message)
+                    continue
+                self.config = config
+                self.config_etag = data.get("etag")
+
+    async def _register_loop(self) -> None:
+        """Retry registration with exponential backoff until it succeeds."""
+        loop = asyncio.get_running_loop()
+        backoff = 1.0
+        while not self._registered_evt.is_set():
+            if not self.token:
+                # No token provided; cannot register automatically.
+                return
+            # Schedule against a deadline so slow requests don't stretch
+            # the retry interval
+            retry_at = loop.time() + backoff
             await self.register_with_cloud()
-        # Always attempt to refresh config periodically
+            if self._registered_evt.is_set():
+                return
+            await asyncio.sleep(max(0.0, retry_at - loop.time()))
+            backoff = min(backoff * 2, self.poll_interval)
+
+    async def _refresh_loop(self) -> None:
+        """Keep the config up to date once the edge is registered.
+
+        The edge waits for the cloud to push config changes over a
+        WebSocket.  Polling is only used as a fallback: after each
+        disconnect the config is fetched once and the stream is reopened
+        with exponential backoff, capped at the poll interval.
+        """
+        await self._registered_evt.wait()
+        loop = asyncio.get_running_loop()
         while True:
-            # If not registered and we have a token, retry registration
-            if not self.registered and self.token:
-                await self.register_with_cloud()
-            # If registered, fetch the config
+            try:
+                await self.stream_config()
+            except (OSError, asyncio.TimeoutError, websockets.WebSocketException):
+                pass
+            except Exception:
+                # Never let an unexpected error end the loop; reconnect below
+                logger.exception("Config stream failed")
+            # Stream is down; reconcile with a plain GET before reconnecting.
+            # The reconnect is due `backoff` seconds after the drop, however
+            # long the GET takes.
+            retry_at = loop.time() + self._backoff
             await self.refresh_config()
-            await asyncio.sleep(15)  # poll every 15 seconds
+            await asyncio.sleep(max(0.0, retry_at - loop.time()))
+            self._backoff = min(self._backoff * 2, self.poll_interval)
+
+    async def run_background_tasks(self) -> None:
+        """Main background task for registration and configuration updates."""
+        await asyncio.gather(self._register_loop(), self._refresh_loop())
 
 
 # Read environment variables
 EDGE_ID = os.getenv("EDGE_ID", "edge-1")
 CLOUD_URL = os.getenv("CLOUD_URL", "http://cloud-api:8080")
 EDGE_TOKEN = os.getenv("EDGE_TOKEN")
+EDGE_POLL_INTERVAL = float(os.getenv("EDGE_POLL_INTERVAL", "15"))
 
 # Initialise state
-state = EdgeState(edge_id=EDGE_ID, cloud_url=CLOUD_URL, token=EDGE_TOKEN)
+state = EdgeState(
+    edge_id=EDGE_ID,
+    cloud_url=CLOUD_URL,
+    token=EDGE_TOKEN,
+    poll_interval=EDGE_POLL_INTERVAL,
+)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    """Create the shared cloud client and launch the background task."""
+    # httpx drops idle connections after 5s by default, which is shorter
+    # than the poll interval.  Keep them alive a little longer than one
+    # interval so each refresh reuses the existing TCP/TLS connection.
+    client = httpx.AsyncClient(
+        base_url=state.cloud_url,
+        timeout=10.0,
+        limits=httpx.Limits(
+            max_keepalive_connections=2,
+            keepalive_expiry=max(20.0, state.poll_interval + 5.0),
+        ),
+    )
+    state.client = client
+    task = asyncio.create_task(state.run_background_tasks())
+    try:
+        yield
+    finally:
+        task.cancel()
+        await client.aclose()
+
 
 # Create app
-app = FastAPI(title=f"Edge Controller {EDGE_ID}", version="0.4.0")
+app = FastAPI(title=f"Edge Controller {EDGE_ID}", version="0.4.0", lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -105,12 +225,6 @@ app.add_middleware(
 )
 
 
-@app.on_event("startup")
-async def on_startup() -> None:
-    """Launch the background task for registration and config refresh."""
-    asyncio.create_task(state.run_background_tasks())
-
-
 @app.get("/health")
 def health() -> Dict[str, str]:
     return {"status": "ok"}
@@ -127,12 +241,27 @@ def status() -> Dict[str, Any]:
     }
 
 
+# Simulated sensors refresh at most this often; faster scrapes reuse the
+# last sample, like reading a real meter between sampling intervals.
+POINTS_SAMPLE_PERIOD = 0.5
+_points_rng = random.Random()
+# (monotonic timestamp, payload) of the last sample
+_points_cache: Tuple[float, Optional[Dict[str, float]]] = (0.0, None)
+
+
 @app.get("/points")
 def points() -> Dict[str, float]:
     """Return a set of dummy measurement points for demonstration."""
-    # Generate random values to simulate changing measurements
-    return {
-        "pcc_active_power_kw": round(random.uniform(-5.0, 5.0), 2),
-        "bess_soc_pct": round(random.uniform(20, 80), 1),
-        "pv_power_kw": round(random.uniform(0, 10.0), 2),
-    }
+    global _points_cache
+    now = time.monotonic()
+    ts, payload = _points_cache
+    if payload is None or now - ts > POINTS_SAMPLE_PERIOD:
+        # Generate random values to simulate changing measurements
+        rng = _points_rng
+        payload = {
+            "pcc_active_power_kw": round(rng.uniform(-5.0, 5.0), 2),
+            "bess_soc_pct": round(rng.uniform(20, 80), 1),
+            "pv_power_kw": round(rng.uniform(0, 10.0), 2),
+        }
+        _points_cache = (now, payload)
+    return payload